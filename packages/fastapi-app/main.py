@@ -1,72 +1,357 @@
+import asyncio
+import contextlib
+import logging
 import os
-import json
+import time
+import weakref
+from collections import OrderedDict
+from contextlib import asynccontextmanager
 
 from typing import Union
 
+import aiosqlite
+import anyio
+import orjson
+from botocore.config import Config as BotocoreConfig
 from fastapi import FastAPI
 from pydantic import BaseModel
 
 from strands import Agent
 from strands_tools import calculator
-from strands.models import BedrockModel
+from strands.models import BedrockModel, CacheConfig
 from tools.manage_user_requests import create_user, get_user, update_user, delete_user, list_all_users
 from mangum import Mangum
 
 
-app = FastAPI()
+logger = logging.getLogger(__name__)
+# Emit INFO records (e.g. per-turn cache usage); uvicorn leaves the root logger unconfigured,
+# while on Lambda the runtime's root handler already ships them to CloudWatch
+logger.setLevel(logging.INFO)
+if not logger.hasHandlers():
+    _log_handler = logging.StreamHandler()
+    _log_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    logger.addHandler(_log_handler)
 
-# Create a Bedrock model instance
+SESSIONS_DB_PATH = "sessions.db"
+
+# Long-lived connection to the session store, opened once at startup
+sessions_db: aiosqlite.Connection = None
+
+# Seconds between background flushes of saved sessions; 0 writes each turn immediately
+SESSION_FLUSH_INTERVAL = float(os.getenv("SESSION_FLUSH_INTERVAL", "0.25"))
+
+# Latest unsaved state per session, waiting for the next flush
+_pending: dict = {}
+# States taken by the flush currently being written
+_flushing: dict = {}
+_flush_lock = asyncio.Lock()
+
+# Sessions whose latest state could not be encoded, with the error; reported on their next request
+_unpersistable: dict = {}
+
+def _check_persistable(session_id):
+    error = _unpersistable.pop(session_id, None)
+    if error is not None:
+        # Drop the live agent so the session continues from its last saved state
+        _agents.pop(session_id, None)
+        raise RuntimeError(f"Session {session_id} could not be saved, its unsaved turns were discarded: {error}")
+
+# Per session: hash of each stored message by seq, so flushes only write messages that are new or changed
+_persisted: "OrderedDict[str, list]" = OrderedDict()
+
+def _remember_persisted(session_id, message_hashes):
+    _persisted[session_id] = message_hashes
+    _persisted.move_to_end(session_id)
+    while len(_persisted) > MAX_CACHED_AGENTS:
+        _persisted.popitem(last=False)
+
+def _encode_sessions(items, now):
+    """Encode pending states into rows, keeping only the messages that are new or changed since the last flush"""
+    rewritten, truncated, session_rows, message_rows, hashes = [], [], [], [], {}
+    for session_id, state in items.items():
+        stored = _persisted.get(session_id)
+
+        try:
+            # The system prompt is static, so it is only written when the row is first created
+            blob = orjson.dumps({"system_prompt": state["system_prompt"]}) if stored is None else None
+            encoded_messages = [orjson.dumps(message) for message in state["messages"]]
+        except Exception as e:
+            # A history that can't be encoded must not hold back the other sessions
+            logger.exception("Session %s could not be saved", session_id)
+            _unpersistable[session_id] = str(e)
+            continue
+
+        message_hashes = [hash(message) for message in encoded_messages]
+        if stored is None:
+            # Unknown stored history, store it from scratch
+            rewritten.append((session_id,))
+            changed = range(len(encoded_messages))
+        else:
+            # Strands edits earlier messages in place (tool result truncation, tracking ids) and trimming
+            # shifts every seq, so compare each stored row rather than assuming an unchanged prefix
+            changed = [
+                seq for seq, message_hash in enumerate(message_hashes)
+                if seq >= len(stored) or stored[seq] != message_hash
+            ]
+            if len(stored) > len(message_hashes):
+                truncated.append((session_id, len(message_hashes)))
+
+        session_rows.append((session_id, blob, now))
+        message_rows.extend((session_id, seq, encoded_messages[seq]) for seq in changed)
+        hashes[session_id] = message_hashes
+    return rewritten, truncated, session_rows, message_rows, hashes
+
+async def flush_pending_sessions():
+    global _pending, _flushing
+    async with _flush_lock:
+        items, _pending = _pending, {}
+        if not items:
+            return
+
+        _flushing = items
+        hashes = dict.fromkeys(items)
+        try:
+            rewritten, truncated, session_rows, message_rows, hashes = await anyio.to_thread.run_sync(
+                _encode_sessions, items, int(time.time())
+            )
+            await sessions_db.executemany("DELETE FROM session_messages WHERE session_id = ?", rewritten)
+            await sessions_db.executemany(
+                "DELETE FROM session_messages WHERE session_id = ? AND seq >= ?", truncated
+            )
+            await sessions_db.executemany(
+                "INSERT INTO sessions (id, blob, updated_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(id) DO UPDATE SET updated_at = excluded.updated_at",
+                session_rows,
+            )
+            await sessions_db.executemany(
+                "INSERT OR REPLACE INTO session_messages (session_id, seq, message) VALUES (?, ?, ?)", message_rows
+            )
+            await sessions_db.commit()
+        except Exception:
+            await sessions_db.rollback()
+            # Requeue what was not superseded by a newer turn in the meantime
+            for session_id in hashes:
+                _pending.setdefault(session_id, items[session_id])
+            raise
+        finally:
+            _flushing = {}
+
+        for session_id, message_hashes in hashes.items():
+            _remember_persisted(session_id, message_hashes)
+
+def _read_legacy_session_files():
+    """Read sessions stored as sessions/{session_id}.json by earlier versions into table rows"""
+    session_rows, message_rows = [], []
+    now = int(time.time())
+    with os.scandir("sessions") as entries:
+        for entry in entries:
+            if not entry.name.endswith('.json'):
+                continue
+            session_id = entry.name[:-len('.json')]
+            try:
+                with open(entry.path, 'rb') as f:
+                    state = orjson.loads(f.read())
+                session_row = (session_id, orjson.dumps({"system_prompt": state["system_prompt"]}), now)
+                new_message_rows = [
+                    (session_id, seq, orjson.dumps(message)) for seq, message in enumerate(state["messages"])
+                ]
+            except Exception:
+                logger.exception("Skipping unreadable session file %s", entry.path)
+                continue
+            session_rows.append(session_row)
+            message_rows.extend(new_message_rows)
+    return session_rows, message_rows
+
+async def _import_legacy_session_files():
+    """Import the JSON session files once, while the sessions table is still empty"""
+    async with sessions_db.execute("SELECT 1 FROM sessions LIMIT 1") as cursor:
+        if await cursor.fetchone() is not None or not os.path.isdir("sessions"):
+            return
+
+    session_rows, message_rows = await anyio.to_thread.run_sync(_read_legacy_session_files)
+    await sessions_db.executemany(
+        "INSERT OR IGNORE INTO sessions (id, blob, updated_at) VALUES (?, ?, ?)", session_rows
+    )
+    await sessions_db.executemany(
+        "INSERT OR IGNORE INTO session_messages (session_id, seq, message) VALUES (?, ?, ?)", message_rows
+    )
+    await sessions_db.commit()
+
+async def flush_sessions_periodically():
+    while True:
+        await asyncio.sleep(SESSION_FLUSH_INTERVAL)
+        try:
+            await flush_pending_sessions()
+        except Exception:
+            logger.exception("Failed to flush sessions")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global sessions_db
+    sessions_db = await aiosqlite.connect(SESSIONS_DB_PATH)
+    await sessions_db.execute("PRAGMA journal_mode=WAL")
+    await sessions_db.execute("PRAGMA synchronous=NORMAL")
+    await sessions_db.execute(
+        "CREATE TABLE IF NOT EXISTS sessions (id TEXT PRIMARY KEY, blob BLOB, updated_at INTEGER)"
+    )
+    # Append-only message log, one row per message
+    await sessions_db.execute(
+        "CREATE TABLE IF NOT EXISTS session_messages ("
+        "session_id TEXT NOT NULL, seq INTEGER NOT NULL, message BLOB NOT NULL, "
+        "PRIMARY KEY (session_id, seq))"
+    )
+    await sessions_db.commit()
+    await _import_legacy_session_files()
+
+    flusher = None
+    if SESSION_FLUSH_INTERVAL > 0:
+        flusher = asyncio.create_task(flush_sessions_periodically())
+    try:
+        yield
+    finally:
+        if flusher is not None:
+            flusher.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await flusher
+        try:
+            await flush_pending_sessions()
+        finally:
+            await sessions_db.close()
+
+app = FastAPI(lifespan=lifespan)
+
+# Bedrock inference tier: "optimized" routes to latency-optimized hardware
+# (only available for some models/regions), "standard" is the default tier
+BEDROCK_PERFORMANCE_LATENCY = os.getenv("BEDROCK_PERFORMANCE_LATENCY", "standard")
+
+# Bedrock prompt cache TTL (e.g. "5m", "1h", or "default" for Bedrock's default); unset by default
+# because the configured model does not support prompt caching on Bedrock
+BEDROCK_PROMPT_CACHE = os.getenv("BEDROCK_PROMPT_CACHE")
+
+# Cache the static prefix (tool definitions + system prompt) on the Bedrock side when enabled
+prompt_cache_config = {}
+if BEDROCK_PROMPT_CACHE:
+    cache_ttl = True if BEDROCK_PROMPT_CACHE == "default" else BEDROCK_PROMPT_CACHE
+    prompt_cache_config = {"cache_config": CacheConfig(tools_ttl=cache_ttl, system_prompt_ttl=cache_ttl)}
+
+# Create a Bedrock model instance; every agent shares it and its pooled bedrock-runtime client
 bedrock_model = BedrockModel(
+    boto_client_config=BotocoreConfig(
+        max_pool_connections=64,
+        retries={"mode": "adaptive"},
+    ),
     model_id="us.anthropic.claude-3-5-sonnet-20240620-v1:0",
     temperature=0.0,
     top_p=0.1,
     top_k=0.1,
     streaming=False,
+    additional_args={"performanceConfig": {"latency": BEDROCK_PERFORMANCE_LATENCY}},
+    **prompt_cache_config,
 )
 
-# Save agent state
-def save_agent_state(agent, session_id):
-    os.makedirs("sessions", exist_ok=True)
+# Built once and shared by every agent instead of being rebuilt on each request
+SYSTEM_PROMPT = (
+    "Eres un agente capaz de gestionar información de usuarios. Puedes crear, leer y actualizar información de usuarios."
+    "Tu objetivo es que funciones como un agente de ventas, el cual deberá responder preguntas relacionadas a la empresa ProIntel, la cual ofrece servicios de Pensión para Colombianos en el Exterior."
+    "Deberás hacerle todas las preguntas necesarias al usuario para poder crear o actualizar su información."
+    "Puedes ir preguntandolo poco a poco e ir guardando la información que te proporcione."
+    "Si el usuario no tiene una cuenta, debes crearla. Si ya tiene una cuenta, debes actualizar su información."
+    "Siempre que el usuario te termine de proporcionar información, debes pasar el usuario a revisión manual por un humano."
+    "Si un usuario te proporciona un número de documento que ya existe, debes verificar que este usuario NO tenga revisión manual requerida, ya que a los usuarios con revisión manual requerida no se les debe atender mas por medio de este Chat con asistente AI si no un humano, entonces debes reusarte a responder mas o a entablar mas conversación, siempre deberás decir que esta en revisión manual y que debe esperar a que un humano se contacte con usted."
+    "Cuando se empieza a pedir información de un usuario, la revisión manual NO es requerida, ya que aun puede que NO tenga toda la información necesaria."
+)
 
-    state = {
-        "messages": agent.messages,
+TOOLS = [calculator, create_user, get_user, update_user, delete_user, list_all_users]
+
+# Live agents kept between turns, least recently used first
+MAX_CACHED_AGENTS = int(os.getenv("MAX_CACHED_AGENTS", "256"))
+_agents: "OrderedDict[str, Agent]" = OrderedDict()
+
+# One lock per session so turns on the same agent never overlap
+_session_locks: "weakref.WeakValueDictionary[str, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+def session_lock(session_id):
+    lock = _session_locks.get(session_id)
+    if lock is None:
+        lock = _session_locks[session_id] = asyncio.Lock()
+    return lock
+
+# Save agent state
+async def save_agent_state(agent, session_id):
+    # Snapshot the history; the agent keeps appending to its own list on later turns
+    _pending[session_id] = {
+        "messages": list(agent.messages),
         "system_prompt": agent.system_prompt
     }
-    # Store state (e.g., database, file system, cache)
-    with open(f"sessions/{session_id}.json", "w") as f:
-        json.dump(state, f)
-
-# Restore agent state
-def restore_agent_state(session_id):
-    try:
-        # Retrieve state
-        with open(f"sessions/{session_id}.json", "r") as f:
-            state = json.load(f)
+    if SESSION_FLUSH_INTERVAL <= 0:
+        await flush_pending_sessions()
+        _check_persistable(session_id)
 
+# Build an agent from a decoded state (or with default values when there is none)
+def _build_agent(state):
+    if state is not None:
         # Create agent with restored state
         return Agent(
             model=bedrock_model,
             messages=state["messages"],
             system_prompt=state["system_prompt"],
-            tools=[calculator, create_user, get_user, update_user, delete_user, list_all_users],
+            tools=TOOLS,
         )
-    except FileNotFoundError:
+    else:
         # Create agent with default values if session doesn't exist
         return Agent(
             model=bedrock_model,
-            system_prompt=(
-                "Eres un agente capaz de gestionar información de usuarios. Puedes crear, leer y actualizar información de usuarios."
-                "Tu objetivo es que funciones como un agente de ventas, el cual deberá responder preguntas relacionadas a la empresa ProIntel, la cual ofrece servicios de Pensión para Colombianos en el Exterior."
-                "Deberás hacerle todas las preguntas necesarias al usuario para poder crear o actualizar su información."
-                "Puedes ir preguntandolo poco a poco e ir guardando la información que te proporcione."
-                "Si el usuario no tiene una cuenta, debes crearla. Si ya tiene una cuenta, debes actualizar su información."
-                "Siempre que el usuario te termine de proporcionar información, debes pasar el usuario a revisión manual por un humano."
-                "Si un usuario te proporciona un número de documento que ya existe, debes verificar que este usuario NO tenga revisión manual requerida, ya que a los usuarios con revisión manual requerida no se les debe atender mas por medio de este Chat con asistente AI si no un humano, entonces debes reusarte a responder mas o a entablar mas conversación, siempre deberás decir que esta en revisión manual y que debe esperar a que un humano se contacte con usted."
-                "Cuando se empieza a pedir información de un usuario, la revisión manual NO es requerida, ya que aun puede que NO tenga toda la información necesaria."
-            ),
-            tools=[calculator, create_user, get_user, update_user, delete_user, list_all_users],
+            system_prompt=SYSTEM_PROMPT,
+            tools=TOOLS,
         )
 
+def _load_agent(blob, message_blobs):
+    if blob is None and not message_blobs:
+        return _build_agent(None)
+
+    state = orjson.loads(blob) if blob is not None else {"system_prompt": SYSTEM_PROMPT}
+    # Sessions saved before the message log keep their whole history in the blob
+    if message_blobs or "messages" not in state:
+        state["messages"] = [orjson.loads(message) for message in message_blobs]
+    return _build_agent(state)
+
+# Restore agent state (callers must hold the session lock); with create=False a session
+# that doesn't exist yet returns None instead of a new agent
+async def restore_agent_state(session_id, create=True):
+    _check_persistable(session_id)
+    agent = _agents.get(session_id)
+
+    if agent is None:
+        state = _pending.get(session_id) or _flushing.get(session_id)
+        if state is not None:
+            # Evicted before its last turn was flushed, rebuild from the unsaved snapshot
+            state = {**state, "messages": list(state["messages"])}
+            agent = await anyio.to_thread.run_sync(_build_agent, state)
+        else:
+            # Retrieve state
+            async with sessions_db.execute("SELECT blob FROM sessions WHERE id = ?", (session_id,)) as cursor:
+                row = await cursor.fetchone()
+            async with sessions_db.execute(
+                "SELECT message FROM session_messages WHERE session_id = ? ORDER BY seq", (session_id,)
+            ) as cursor:
+                message_blobs = [message for (message,) in await cursor.fetchall()]
+            if row is None and not message_blobs and not create:
+                return None
+
+            # Decoding the history and building the agent is CPU work, keep it off the event loop
+            agent = await anyio.to_thread.run_sync(
+                _load_agent, row[0] if row is not None else None, message_blobs
+            )
+            if message_blobs:
+                _remember_persisted(session_id, [hash(message) for message in message_blobs])
+        _agents[session_id] = agent
+
+    _agents.move_to_end(session_id)
+    while len(_agents) > MAX_CACHED_AGENTS:
+        _agents.popitem(last=False)
+
+    return agent
+
 class Message(BaseModel):
     message: str
 
@@ -74,35 +359,54 @@ class Messages(BaseModel):
     messages: list[Message]
 
 @app.get("/")
-def read_root():
+async def read_root():
     return {"Hello": "World"}
 
 
 @app.get("/chat/{session_id}")
-def chat_history(session_id: str):
+async def chat_history(session_id: str):
     try:
-        agent = restore_agent_state(session_id)
-        return {"messages": agent.messages}
-    except FileNotFoundError:
-        return {"error": "Session not found"}
+        async with session_lock(session_id):
+            # Unknown sessions are not cached, a read alone must not evict live agents
+            agent = await restore_agent_state(session_id, create=False)
+            if agent is None:
+                return {"messages": []}
+            # Copy while holding the lock, a later turn appends to the live list from a worker thread
+            return {"messages": list(agent.messages)}
     except Exception as e:
         return {"error": str(e)}
 
 
 @app.post("/chat/{session_id}")
-def chat(session_id: str, message: Message):
-    agent = restore_agent_state(session_id)
+async def chat(session_id: str, message: Message):
+    async with session_lock(session_id):
+        agent = await restore_agent_state(session_id)
 
-    # Process the incoming message
-    result = agent(message.message)
+        # Process the incoming message (the Bedrock call is blocking, keep it off the event loop)
+        try:
+            result = await anyio.to_thread.run_sync(agent, message.message)
+        except Exception:
+            # A failed turn can leave a partial history behind, restart from the last saved state
+            _agents.pop(session_id, None)
+            raise
+
+        # Track prompt cache effectiveness
+        usage = result.metrics.accumulated_usage
+        logger.info(
+            "Session %s usage: input=%s cache_read=%s cache_write=%s",
+            session_id,
+            usage.get("inputTokens", 0),
+            usage.get("cacheReadInputTokens", 0),
+            usage.get("cacheWriteInputTokens", 0),
+        )
 
-    # print(f"Received message: {result.message}")
-    # print(f"Metrics message: {result.metrics}")
-    # print(f"State used: {result.state}")
-    # print(f"Stop Reason used: {result.stop_reason}")
+        # print(f"Received message: {result.message}")
+        # print(f"Metrics message: {result.metrics}")
+        # print(f"State used: {result.state}")
+        # print(f"Stop Reason used: {result.stop_reason}")
 
-    # Save the updated state
-    save_agent_state(agent, session_id)
+        # Save the updated state
+        await save_agent_state(agent, session_id)
 
     return {
         "response": result.message.get("content", "")[0].get("text", ""),
@@ -1,32 +1,91 @@
 # manage_user_requests.py
 
+import io
+import logging
 import os
-import json
+import re
+import sqlite3
+import threading
+import orjson
 from typing import Optional, Dict, Any, List
-from pydantic import BaseModel, EmailStr, validator
+from pydantic import BaseModel, TypeAdapter, ValidationError, field_validator
 from strands import tool
 
+logger = logging.getLogger(__name__)
+
+# Basic shape check for emails, avoids pulling email-validator in through EmailStr
+_EMAIL_PATTERN = re.compile(r"[^@\s]+@[^@\s]+\.[^@\s]+")
+
 class User(BaseModel):
     documentNumber: int
     firstName: Optional[str] = None
     lastName: Optional[str] = None
     phone: Optional[str] = None
-    email: Optional[EmailStr] = None
+    email: Optional[str] = None
     manual_review_required: Optional[bool] = False
     
-    @validator('phone')
+    @field_validator('phone')
+    @classmethod
     def validate_phone(cls, v):
         if v is not None and not v.startswith('+'):
             raise ValueError('Phone number must include country code starting with +')
         return v
+    
+    @field_validator('email')
+    @classmethod
+    def validate_email(cls, v):
+        if v is not None and not _EMAIL_PATTERN.fullmatch(v):
+            raise ValueError('Invalid email address')
+        return v
+
+USERS_DB_PATH = "users.db"
+
+# Upper bound for document numbers; anything outside (0, MAX_DOCUMENT_NUMBER) is rejected before querying
+MAX_DOCUMENT_NUMBER = 10**12
+
+# Single connection shared by every tool call; the agent runs tools from worker threads
+_db = sqlite3.connect(USERS_DB_PATH, check_same_thread=False)
+_db_lock = threading.Lock()
 
-def _ensure_users_directory():
-    """Ensure the users directory exists"""
-    os.makedirs("users", exist_ok=True)
+def _init_users_db():
+    """Create the users table and import users stored as JSON files by earlier versions"""
+    with _db_lock, _db:
+        _db.execute("PRAGMA journal_mode=WAL")
+        _db.execute("CREATE TABLE IF NOT EXISTS users (document_number INTEGER PRIMARY KEY, data BLOB NOT NULL)")
+        # Records are stored as UTF-8 JSON bytes; convert rows an earlier version wrote as TEXT
+        _db.execute("UPDATE users SET data = CAST(data AS BLOB) WHERE typeof(data) = 'text'")
 
-def _get_user_file_path(document_number: int) -> str:
-    """Get the file path for a user's JSON file"""
-    return f"users/{document_number}.json"
+        if _db.execute("SELECT 1 FROM users LIMIT 1").fetchone() is not None or not os.path.isdir("users"):
+            return
+
+        rows = []
+        with os.scandir("users") as entries:
+            for entry in entries:
+                if not entry.name.endswith('.json'):
+                    continue
+                try:
+                    with open(entry.path, 'rb') as f:
+                        user_data = orjson.loads(f.read())
+                    document_number = int(user_data['documentNumber'])
+                except Exception:
+                    logger.exception("Skipping unreadable user file %s", entry.path)
+                    continue
+                rows.append((document_number, orjson.dumps(user_data)))
+        _db.executemany("INSERT OR IGNORE INTO users (document_number, data) VALUES (?, ?)", rows)
+
+def _is_valid_document_number(document_number: int) -> bool:
+    """Check that a document number is in range"""
+    return 0 < document_number < MAX_DOCUMENT_NUMBER
+
+def _load_user(document_number: int) -> Optional[Dict[str, Any]]:
+    """Get a user's stored data, or None if the user does not exist"""
+    with _db_lock:
+        row = _db.execute("SELECT data FROM users WHERE document_number = ?", (document_number,)).fetchone()
+    return orjson.loads(row[0]) if row is not None else None
+
+_init_users_db()
+
+_users_adapter = TypeAdapter(List[User])
 
 @tool
 def create_user(document_number: int, first_name: Optional[str] = None, last_name: Optional[str] = None, phone: Optional[str] = None, email: Optional[str] = None, manual_review_required: bool = False) -> str:
@@ -41,12 +100,8 @@ def create_user(document_number: int, first_name: Optional[str] = None, last_nam
         manual_review_required: Whether manual review is required for this user (default: False)
     """
     try:
-        _ensure_users_directory()
-        
-        # Check if user already exists
-        file_path = _get_user_file_path(document_number)
-        if os.path.exists(file_path):
-            return f"Error: User with document number {document_number} already exists"
+        if not _is_valid_document_number(document_number):
+            return "Error: Invalid document number"
         
         # Validate user data
         user = User(
@@ -58,9 +113,15 @@ def create_user(document_number: int, first_name: Optional[str] = None, last_nam
             manual_review_required=manual_review_required
         )
         
-        # Save user to JSON file
-        with open(file_path, 'w') as f:
-            json.dump(user.dict(), f, indent=2)
+        # Save user, the primary key rejects existing document numbers
+        try:
+            with _db_lock, _db:
+                _db.execute(
+                    "INSERT INTO users (document_number, data) VALUES (?, ?)",
+                    (document_number, user.model_dump_json().encode()),
+                )
+        except sqlite3.IntegrityError:
+            return f"Error: User with document number {document_number} already exists"
         
         name_display = f"{first_name or ''} {last_name or ''}".strip() or f"Document {document_number}"
         return f"User {name_display} created successfully with document number {document_number}"
@@ -76,13 +137,13 @@ def get_user(document_number: int) -> str:
         document_number: User's document/ID number
     """
     try:
-        file_path = _get_user_file_path(document_number)
+        if not _is_valid_document_number(document_number):
+            return "Error: Invalid document number"
         
-        if not os.path.exists(file_path):
-            return f"Error: User with document number {document_number} not found"
+        user_data = _load_user(document_number)
         
-        with open(file_path, 'r') as f:
-            user_data = json.load(f)
+        if user_data is None:
+            return f"Error: User with document number {document_number} not found"
         
         name = f"{user_data.get('firstName', 'N/A')} {user_data.get('lastName', 'N/A')}".strip()
         if name == "N/A N/A":
@@ -110,14 +171,14 @@ def update_user(document_number: int, first_name: Optional[str] = None, last_nam
         manual_review_required: Whether manual review is required for this user (optional)
     """
     try:
-        file_path = _get_user_file_path(document_number)
-        
-        if not os.path.exists(file_path):
-            return f"Error: User with document number {document_number} not found"
+        if not _is_valid_document_number(document_number):
+            return "Error: Invalid document number"
         
         # Load existing user data
-        with open(file_path, 'r') as f:
-            user_data = json.load(f)
+        user_data = _load_user(document_number)
+        
+        if user_data is None:
+            return f"Error: User with document number {document_number} not found"
         
         # Update fields if provided
         if first_name is not None:
@@ -131,12 +192,18 @@ def update_user(document_number: int, first_name: Optional[str] = None, last_nam
         if manual_review_required is not None:
             user_data['manual_review_required'] = manual_review_required
         
-        # Validate updated data
-        user = User(**user_data)
+        # Stored records are already valid, so only re-validate when a field with rules changed
+        if phone is not None or email is not None:
+            data = User.model_validate(user_data).model_dump_json().encode()
+        else:
+            data = orjson.dumps(user_data)
         
         # Save updated data
-        with open(file_path, 'w') as f:
-            json.dump(user.dict(), f, indent=2)
+        with _db_lock, _db:
+            _db.execute(
+                "UPDATE users SET data = ? WHERE document_number = ?",
+                (data, document_number),
+            )
         
         return f"User {user_data['firstName']} {user_data['lastName']} updated successfully"
         
@@ -151,17 +218,19 @@ def delete_user(document_number: int) -> str:
         document_number: User's document/ID number
     """
     try:
-        file_path = _get_user_file_path(document_number)
+        if not _is_valid_document_number(document_number):
+            return "Error: Invalid document number"
         
-        if not os.path.exists(file_path):
-            return f"Error: User with document number {document_number} not found"
+        # Delete the record and get its data back in the same statement
+        with _db_lock, _db:
+            row = _db.execute(
+                "DELETE FROM users WHERE document_number = ? RETURNING data", (document_number,)
+            ).fetchone()
         
-        # Get user info before deletion
-        with open(file_path, 'r') as f:
-            user_data = json.load(f)
+        if row is None:
+            return f"Error: User with document number {document_number} not found"
         
-        # Delete the file
-        os.remove(file_path)
+        user_data = orjson.loads(row[0])
         
         return f"User {user_data['firstName']} {user_data['lastName']} with document number {document_number} deleted successfully"
         
@@ -173,29 +242,34 @@ def list_all_users() -> str:
     """List all users in the system
     """
     try:
-        _ensure_users_directory()
+        with _db_lock:
+            records = [orjson.loads(data) for (data,) in _db.execute("SELECT data FROM users")]
         
-        user_files = [f for f in os.listdir("users") if f.endswith('.json')]
-        
-        if not user_files:
+        if not records:
             return "No users found in the system"
         
-        users_info = []
-        for file_name in user_files:
-            with open(f"users/{file_name}", 'r') as f:
-                user_data = json.load(f)
-                
-                name = f"{user_data.get('firstName', 'N/A')} {user_data.get('lastName', 'N/A')}".strip()
-                if name == "N/A N/A":
-                    name = "N/A"
-                
-                phone = user_data.get('phone', 'N/A')
-                email = user_data.get('email', 'N/A')
-                review_status = "Yes" if user_data.get('manual_review_required', False) else "No"
-                
-                users_info.append(f"Doc: {user_data['documentNumber']}, Name: {name}, Phone: {phone}, Email: {email}, Manual Review: {review_status}")
-        
-        return "Users in system:\n" + "\n".join(users_info)
+        # Validate the whole batch in one pass instead of row by row; rows written before
+        # validation existed (e.g. phones without a country code) are listed as stored
+        try:
+            users = _users_adapter.validate_python(records)
+            records = [user.model_dump(exclude_unset=True) for user in users]
+        except ValidationError:
+            logger.warning("Listing users without validation, some stored records are invalid")
+        
+        buf = io.StringIO()
+        buf.write("Users in system:")
+        for user_data in records:
+            name = f"{user_data.get('firstName', 'N/A')} {user_data.get('lastName', 'N/A')}".strip()
+            if name == "N/A N/A":
+                name = "N/A"
+            
+            phone = user_data.get('phone', 'N/A')
+            email = user_data.get('email', 'N/A')
+            review_status = "Yes" if user_data.get('manual_review_required', False) else "No"
+            
+            buf.write(f"\nDoc: {user_data.get('documentNumber', 'N/A')}, Name: {name}, Phone: {phone}, Email: {email}, Manual Review: {review_status}")
+        
+        return buf.getvalue()
         
     except Exception as e:
         return f"Error listing users: {str(e)}"
\ No newline at end of file